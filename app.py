@@ -1,157 +1,639 @@
 import os
+import re
+import math
 import time
+import random
+import functools
 import json
-import requests
+import shelve
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
-from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+# `requests` and `dotenv` are imported on first use to keep cold start fast
+try:
+    # Optional: much faster on large OCR payloads; its errors subclass JSONDecodeError
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 # -----------------------------
 # Load environment variables
 # -----------------------------
-load_dotenv()
-# Phase-1 (OpenAI)
-AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+def _positive_float_env(name: str, default: float) -> float:
+    """Float env var; missing, malformed or non-positive values fall back to `default`."""
+    try:
+        value = float(os.getenv(name, default))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+@st.cache_resource(show_spinner=False)
+def get_settings() -> dict:
+    """Azure credentials and app settings, read from the environment / .env on first access."""
+    from dotenv import load_dotenv
+    load_dotenv()
+    return {
+        # Phase-1 (OpenAI)
+        "AZURE_OPENAI_KEY": os.getenv("AZURE_OPENAI_KEY"),
+        "AZURE_OPENAI_ENDPOINT": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "AZURE_OPENAI_DEPLOYMENT": os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        "AZURE_OPENAI_API_VERSION": os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+        # Phase-2 (OCR / Computer Vision Read v3.2 GA)
+        "AZURE_OCR_KEY": os.getenv("AZURE_OCR_KEY"),
+        "AZURE_OCR_ENDPOINT": os.getenv("AZURE_OCR_ENDPOINT"),  # e.g. https://xxx.cognitiveservices.azure.com/
+        "AZURE_OCR_TIMEOUT": _positive_float_env("AZURE_OCR_TIMEOUT", 60.0),  # seconds per receipt
+        # Persistent cache for OpenAI responses (survives app restarts)
+        "LLM_CACHE_PATH": os.getenv("LLM_CACHE_PATH", ".llm_cache"),
+    }
 
-# Phase-2 (OCR / Computer Vision Read v3.2 GA)
-AZURE_OCR_KEY = os.getenv("AZURE_OCR_KEY")
-AZURE_OCR_ENDPOINT = os.getenv("AZURE_OCR_ENDPOINT")  # e.g. https://xxx.cognitiveservices.azure.com/
+# OCR polling: start fast, back off up to the max delay, give up after
+# settings["AZURE_OCR_TIMEOUT"] (Retry-After from the service takes precedence)
+OCR_POLL_MIN_DELAY = 0.25
+OCR_POLL_MAX_DELAY = 2.0
+
+# Multi-receipt OCR: receipts in flight at once, and submit rate limit
+OCR_MAX_CONCURRENCY = 8
+OCR_MAX_SUBMITS_PER_SEC = 10.0
+_ocr_rate_lock = threading.Lock()
+_ocr_next_submit = 0.0
+
+# Manual-entry fast path: `Item - price` lists whose lines all parse and whose
+# items all appear below are classified locally without calling OpenAI
+_ITEM_LINE_RE = re.compile(r"^\s*([^-\n]+?)\s*-\s*(\d+(?:\.\d+)?)\s*$")
+# Several manual lists are separated by a `---` line and classified in one call
+_LIST_SEPARATOR_RE = re.compile(r"^\s*-{3,}\s*$", re.MULTILINE)
+_BATCH_SEPARATOR = "\n---NEXT-LIST---\n"
+# Lists per batch call, on top of MAX_PROMPT_CHARS, so the JSON array reply stays short
+CLASSIFY_BATCH_MAX_LISTS = 8
+ESSENTIALS = {
+    "milk", "bread", "rice", "eggs", "egg", "flour", "atta", "sugar", "salt", "oil",
+    "butter", "cheese", "yogurt", "curd", "lentils", "dal", "beans", "pasta", "oats",
+    "chicken", "fish", "meat", "potatoes", "potato", "onions", "onion", "tomatoes",
+    "tomato", "vegetables", "fruit", "apples", "bananas", "water", "tea", "soap",
+    "shampoo", "toothpaste", "detergent",
+}
+NON_ESSENTIALS = {
+    "chips", "crisps", "soda", "coke", "cola", "coca cola", "pepsi", "candy",
+    "chocolate", "cookies", "biscuits", "cake", "ice cream", "beer", "wine",
+    "energy drink", "snacks", "popcorn", "gum", "donuts",
+}
+
+# Prompt input budget (~2k tokens) and receipt lines that never hold an item
+MAX_PROMPT_CHARS = 8000
+_RECEIPT_BOILERPLATE_RE = re.compile(
+    r"^(?:(?:sub\s*total|total|vat|thank you|cashier|barcode)\b|\d{4,}\s*$)",
+    re.IGNORECASE,
+)
+
+# Static system prompts. They never change between calls, and the variable text
+# is sent alone as the user message, so every request shares the same prefix.
+# All three ask for the same analysis shape, defined once here.
+_ANALYSIS_EXAMPLE = """\
+{
+    "essentials": [{"item": "Milk", "quantity":1, "price":3}],
+    "non_essentials": [{"item": "Chips", "quantity":1, "price":4}],
+    "suggestions": ["Suggestion 1", "Suggestion 2"]
+}
+"""
+
+_CLASSIFY_SYS = f"""\
+You are a budgeting assistant that outputs JSON only. The user will give you a grocery list with items, quantities, and prices.
+Classify each item into 'Essential' or 'Non-Essential'.
+Return the result as JSON like this:
+{_ANALYSIS_EXAMPLE}"""
+
+_CLASSIFY_BATCH_SYS = f"""\
+You are a budgeting assistant that outputs JSON only. The user will give you several grocery lists with items, quantities, and prices.
+The lists are separated by lines reading {_BATCH_SEPARATOR.strip()}.
+Classify each item of every list into 'Essential' or 'Non-Essential'.
+Return a JSON array with exactly one object per list, in the same order, each shaped like this:
+{_ANALYSIS_EXAMPLE}"""
+
+_RECEIPT_SYS = f"""\
+You are a budgeting assistant that outputs JSON only. The user provides a raw receipt text.
+Extract only the purchased items with their quantity (default 1 if not present) and total price.
+Ignore any other irrelevant text (store info, barcodes, date, totals, etc.).
+Classify each item into 'Essential' or 'Non-Essential'.
+Return the result as JSON like this:
+{_ANALYSIS_EXAMPLE}"""
+
+# Retries for Azure rate limits / transient failures: bounded, exponential with jitter
+RETRY_ATTEMPTS = 3
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Serializes access to the shelve file at settings["LLM_CACHE_PATH"]
+_llm_cache_lock = threading.Lock()
 
 # -----------------------------
 # Helpers
 # -----------------------------
-def _safe_sum(items):
-    total = 0.0
-    for it in items or []:
-        try:
-            total += float(it.get("price", 0) or 0)
-        except Exception:
-            pass
-    return total
+class ServiceError(Exception):
+    """
+    An Azure call failed. Raised out of cached functions so `st.cache_data`
+    never stores the failure; the UI shows `str(e)` and the optional `detail`.
+    """
+    def __init__(self, message: str, detail=None):
+        super().__init__(message)
+        self.detail = detail
 
-# -----------------------------
-# Phase-1: classify items via OpenAI
-# -----------------------------
-def classify_items_with_ai(grocery_text: str):
-    url = f"{AZURE_OPENAI_ENDPOINT}/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions?api-version={AZURE_OPENAI_API_VERSION}"
-    headers = {"Content-Type": "application/json", "api-key": AZURE_OPENAI_KEY}
-
-    prompt = f"""
-    You are a budgeting assistant. The user will give you a grocery list with items, quantities, and prices.
-    Classify each item into 'Essential' or 'Non-Essential'.
-    Return the result as JSON like this:
-    {{
-        "essentials": [{{"item": "Milk", "quantity":1, "price":3}}],
-        "non_essentials": [{{"item": "Chips", "quantity":1, "price":4}}],
-        "suggestions": ["Suggestion 1", "Suggestion 2"]
-    }}
-    Here is the list:
-    {grocery_text}
+def _price(value):
+    """`value` as a float (e.g. 3, "3.", " .5", "-1.50"), or None if it isn't a finite number."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        price = float(value)
+    except (ValueError, OverflowError):
+        return None
+    # "nan" and "inf" parse, but would make every total meaningless
+    return price if math.isfinite(price) else None
+
+def _prices(items) -> list[float]:
+    """Numeric prices of `items`; missing or unparseable prices are skipped."""
+    return [
+        p for it in items or []
+        if isinstance(it, dict) and (p := _price(it.get("price"))) is not None
+    ]
+
+def _totals(essentials, non_essentials):
+    """(essentials, non-essentials, total spent, saving if removed, saving if halved)."""
+    essentials_total = math.fsum(_prices(essentials))
+    non_essentials_total = math.fsum(_prices(non_essentials))
+    return (
+        essentials_total,
+        non_essentials_total,
+        essentials_total + non_essentials_total,
+        non_essentials_total,
+        non_essentials_total / 2.0,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_session():
+    """One pooled keep-alive `requests.Session` shared by every Azure call."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # Only connect failures (nothing was sent yet) are retried here; read errors
+    # are not, as that could re-POST. HTTP 429/5xx retries live in `_retry_transient`
+    retry = Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5)
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry))
+    return session
+
+def _retry_after(resp, default: float) -> float:
+    """Seconds the service asked us to wait, falling back to `default`."""
+    try:
+        return max(float(resp.headers.get("Retry-After", default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+def _retry_transient(fn):
     """
+    Retry `fn` when it raises HTTPError for a 429/5xx response, with jittered
+    exponential backoff that never undercuts Retry-After; other errors fail at
+    once. Pass `retry_deadline` (a time.monotonic() value) to give up rather
+    than sleep past it; a Retry-After over RETRY_MAX_DELAY also gives up.
 
+    `on_retry(delay, attempt)` is called before each wait. It stays silent by
+    default because calls made under `st.cache_data` must not emit elements.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, retry_deadline=None, on_retry=None, **kwargs):
+        import requests
+
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                return fn(*args, **kwargs)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in RETRY_STATUSES or attempt == RETRY_ATTEMPTS:
+                    raise
+                server_wait = _retry_after(e.response, 0.0)
+                if server_wait > RETRY_MAX_DELAY:
+                    raise
+                backoff = min(RETRY_INITIAL_DELAY * 2 ** (attempt - 1) + random.uniform(0, 1), RETRY_MAX_DELAY)
+                delay = max(backoff, server_wait)
+                if retry_deadline is not None and time.monotonic() + delay >= retry_deadline:
+                    raise
+                if on_retry is not None:
+                    on_retry(delay, attempt)
+                time.sleep(delay)
+    return wrapper
+
+def _toast_retry(delay: float, attempt: int) -> None:
+    st.toast(f"Azure is busy, retrying in {delay:.0f}s… ({attempt}/{RETRY_ATTEMPTS - 1})")
+
+@_retry_transient
+def _azure_get(url: str, **kwargs):
+    """GET on the shared session that raises on HTTP errors."""
+    resp = get_session().get(url, **kwargs)
+    resp.raise_for_status()
+    return resp
+
+@_retry_transient
+def _submit_receipt(url: str, headers: dict, file_bytes: bytes):
+    """POST one receipt to the Read API; every attempt respects the submit rate limit."""
+    _throttle_ocr_submit()
+    resp = get_session().post(url, headers=headers, data=file_bytes, timeout=60)
+    resp.raise_for_status()
+    return resp
+
+def _throttle_ocr_submit() -> None:
+    """Space out OCR submits so we stay under OCR_MAX_SUBMITS_PER_SEC."""
+    global _ocr_next_submit
+    with _ocr_rate_lock:
+        now = time.monotonic()
+        wait = _ocr_next_submit - now
+        _ocr_next_submit = max(now, _ocr_next_submit) + 1.0 / OCR_MAX_SUBMITS_PER_SEC
+    if wait > 0:
+        time.sleep(wait)
+
+def _local_category(item: str):
+    """'essential' / 'non_essential' for a known item, None if unknown or ambiguous."""
+    name = item.strip().lower()
+    words = set(name.split()) | {name}
+    is_essential = bool(words & ESSENTIALS)
+    is_non_essential = bool(words & NON_ESSENTIALS)
+    if is_essential == is_non_essential:
+        return None
+    return "essential" if is_essential else "non_essential"
+
+def _classify_locally(grocery_text: str):
+    """
+    Classify an `Item - price` list without AI. Returns the same shape as
+    `classify_items_with_ai`, or None when the list needs the model.
+    """
+    lines = [l for l in grocery_text.splitlines() if l.strip()]
+    matches = [_ITEM_LINE_RE.match(l) for l in lines]
+    # Any line we can't parse goes to the model, or its price would be lost
+    if not matches or not all(matches):
+        return None
+
+    result = {"essentials": [], "non_essentials": [], "suggestions": []}
+    for m in matches:
+        category = _local_category(m.group(1))
+        if category is None:
+            return None
+        entry = {"item": m.group(1).strip(), "quantity": 1, "price": float(m.group(2))}
+        result["essentials" if category == "essential" else "non_essentials"].append(entry)
+
+    for it in sorted(result["non_essentials"], key=lambda it: it["price"], reverse=True)[:3]:
+        result["suggestions"].append(f"Skip {it['item']} to save Rs.{it['price']:.2f}.")
+    if not result["suggestions"]:
+        result["suggestions"].append("Your list only has essentials. Nice work!")
+    return result
+
+def _clamp_prompt_text(text: str) -> str:
+    """Cut `text` at the last full line that fits in MAX_PROMPT_CHARS."""
+    if len(text) <= MAX_PROMPT_CHARS:
+        return text
+    cut = text.rfind("\n", 0, MAX_PROMPT_CHARS)
+    return text[:cut if cut > 0 else MAX_PROMPT_CHARS]
+
+def _flag_truncated(data: dict, text: str, prompt: str) -> dict:
+    """
+    `data` marked `"truncated"` when `prompt` is only the start of `text`, so
+    the warning is rendered with the analysis on every rerun, not just once.
+    """
+    return {**data, "truncated": True} if len(prompt) < len(text) else data
+
+def _compact_receipt_text(raw_text: str) -> str:
+    """
+    Shrink OCR output before it goes to the model: collapse whitespace and drop
+    empty and boilerplate lines (totals, VAT, barcodes...).
+    """
+    lines = (" ".join(line.split()) for line in raw_text.splitlines())
+    kept = [line for line in lines if line and not _RECEIPT_BOILERPLATE_RE.match(line)]
+    return "\n".join(kept)
+
+def _is_analysis(value) -> bool:
+    """True for a reply shaped like {"essentials": [...], "non_essentials": [...]}."""
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get("essentials"), list)
+        and isinstance(value.get("non_essentials"), list)
+    )
+
+def _llm_cache_key(system: str, user_text: str) -> str:
+    """Content hash of everything that determines the model's answer."""
+    cfg = get_settings()
+    raw = f"{cfg['AZURE_OPENAI_DEPLOYMENT']}|{cfg['AZURE_OPENAI_API_VERSION']}|{system}|{user_text}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _llm_cache_get(key: str):
+    try:
+        with _llm_cache_lock, shelve.open(get_settings()["LLM_CACHE_PATH"]) as cache:
+            return cache.get(key)
+    except Exception:
+        return None
+
+def _llm_cache_set(key: str, value) -> None:
+    try:
+        with _llm_cache_lock, shelve.open(get_settings()["LLM_CACHE_PATH"]) as cache:
+            cache[key] = value
+    except Exception:
+        pass
+
+@_retry_transient
+def _stream_chat_completion(body: dict) -> str:
+    """
+    POST a chat completion with `stream: true` and return the full reply text,
+    showing the partial output while tokens arrive.
+
+    Never call this under `st.cache_data`: Streamlit would record every token
+    update and replay them on cache hits. Replies are memoized by the
+    `.llm_cache` disk cache (and session state in the UI) instead.
+    """
+    cfg = get_settings()
+    url = f"{cfg['AZURE_OPENAI_ENDPOINT']}/openai/deployments/{cfg['AZURE_OPENAI_DEPLOYMENT']}/chat/completions?api-version={cfg['AZURE_OPENAI_API_VERSION']}"
+    headers = {"Content-Type": "application/json", "api-key": cfg["AZURE_OPENAI_KEY"]}
+
+    placeholder = st.empty()
+    content = ""
+    try:
+        with get_session().post(url, headers=headers, json={**body, "stream": True}, stream=True, timeout=60) as resp:
+            if not resp.ok:
+                _ = resp.content  # buffer the error body before the stream is closed
+            resp.raise_for_status()
+            resp.encoding = "utf-8"
+            for line in resp.iter_lines(decode_unicode=True):
+                # Server-sent events: `data: {...}` per chunk, `data: [DONE]` at the end
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    event = _json_loads(data)
+                except json.JSONDecodeError:
+                    raise ServiceError("Azure OpenAI sent a malformed stream chunk:", data) from None
+                if not isinstance(event, dict):
+                    raise ServiceError("Azure OpenAI sent a malformed stream chunk:", data)
+                if "error" in event:
+                    raise ServiceError("Azure OpenAI reported an error while streaming:", event["error"])
+                for choice in event.get("choices", []):
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        content += delta
+                        placeholder.code(content)
+    finally:
+        # A retry starts a fresh placeholder, so never leave partial output behind
+        placeholder.empty()
+    return content
+
+def _chat_json(system: str, user_text: str, validate=_is_analysis):
+    """
+    Send `user_text` to Azure OpenAI under the static `system` instructions and
+    parse the JSON reply, raising ServiceError on failure. Only replies accepted
+    by `validate` are returned or cached, so a malformed answer is retried.
+
+    Keeping the instructions byte-identical across calls and the variable
+    text last lets the service reuse its prompt cache for the shared prefix.
+    """
     body = {
         "messages": [
-            {"role": "system", "content": "You are a helpful AI that outputs JSON only."},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": system},
+            {"role": "user", "content": user_text}
         ],
         "temperature": 0.2
     }
 
+    cache_key = _llm_cache_key(system, user_text)
+    cached = _llm_cache_get(cache_key)
+    if cached is not None and validate(cached):
+        return cached
+
+    import requests
+
+    content = None
     try:
-        resp = requests.post(url, headers=headers, json=body, timeout=60)
-        resp.raise_for_status()
-        payload = resp.json()
-        content = payload["choices"][0]["message"]["content"]
-        return json.loads(content)
+        # Uncached call, so the user can be told about retries
+        content = _stream_chat_completion(body, on_retry=_toast_retry)
+        result = _json_loads(content)
     except json.JSONDecodeError:
-        st.error("AI did not return valid JSON. Showing raw content:")
-        st.write(payload["choices"][0]["message"]["content"] if "payload" in locals() else "(no content)")
-        return None
-    except requests.HTTPError:
-        st.error("Azure OpenAI HTTP error")
+        raise ServiceError("AI did not return valid JSON. Showing raw content:", content or "(no content)") from None
+    except requests.HTTPError as e:
         try:
-            st.json(resp.json())
+            detail = e.response.json()
         except Exception:
-            st.write(str(resp.text))
-        return None
+            detail = str(e.response.text)
+        raise ServiceError("Azure OpenAI HTTP error", detail) from e
+    except ServiceError:
+        raise
     except Exception as e:
-        st.error(f"Unexpected error calling Azure OpenAI: {e}")
-        return None
+        raise ServiceError(f"Unexpected error calling Azure OpenAI: {e}") from e
+
+    if not validate(result):
+        raise ServiceError("AI reply did not have the expected structure. Showing raw content:", content)
+    _llm_cache_set(cache_key, result)
+    return result
+
+# -----------------------------
+# Phase-1: classify items via OpenAI
+# -----------------------------
+def classify_items_with_ai(grocery_text: str):
+    local = _classify_locally(grocery_text)
+    if local is not None:
+        return local
+    prompt = _clamp_prompt_text(grocery_text)
+    return _flag_truncated(_chat_json(_CLASSIFY_SYS, prompt), grocery_text, prompt)
+
+def classify_items_batch(texts: list[str]):
+    """
+    Classify several grocery lists in as few OpenAI calls as the prompt budget
+    allows. Returns one result per list (same shape as `classify_items_with_ai`).
+    """
+    results = [_classify_locally(t) for t in texts]
+    todo = [i for i, r in enumerate(results) if r is None]
+    for batch in _prompt_batches([texts[i] for i in todo]):
+        indexes = [todo[j] for j in batch]
+        if len(indexes) == 1:
+            # Sent alone, so a list over the budget is clamped like a single one
+            text = texts[indexes[0]]
+            prompt = _clamp_prompt_text(text)
+            results[indexes[0]] = _flag_truncated(_chat_json(_CLASSIFY_SYS, prompt), text, prompt)
+            continue
+        joined = _BATCH_SEPARATOR.join(texts[i] for i in indexes)
+        # Checked before caching: one analysis-shaped object per list sent
+        reply = _chat_json(
+            _CLASSIFY_BATCH_SYS,
+            joined,
+            validate=lambda r, n=len(indexes): isinstance(r, list) and len(r) == n and all(map(_is_analysis, r)),
+        )
+        for i, data in zip(indexes, reply):
+            results[i] = data
+    return results
+
+def _prompt_batches(texts: list[str]) -> list[list[int]]:
+    """
+    Group the indexes of `texts` into runs of at most CLASSIFY_BATCH_MAX_LISTS
+    whose joined text fits in MAX_PROMPT_CHARS; an oversized text runs alone.
+    """
+    batches, size = [], 0
+    for i, text in enumerate(texts):
+        # Each list costs its text plus one separator; the budget allows for the missing last one
+        cost = len(text) + len(_BATCH_SEPARATOR)
+        if batches and len(batches[-1]) < CLASSIFY_BATCH_MAX_LISTS and size + cost <= MAX_PROMPT_CHARS + len(_BATCH_SEPARATOR):
+            batches[-1].append(i)
+            size += cost
+        else:
+            batches.append([i])
+            size = cost
+    return batches
 
 # -----------------------------
 # Phase-2: OCR via Computer Vision Read v3.2
 # -----------------------------
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=128)
 def extract_text_from_receipt(file_bytes: bytes) -> str:
-    analyze_url = f"{AZURE_OCR_ENDPOINT}vision/v3.2/read/analyze"
-    headers = {"Ocp-Apim-Subscription-Key": AZURE_OCR_KEY, "Content-Type": "application/octet-stream"}
+    cfg = get_settings()
+    analyze_url = f"{cfg['AZURE_OCR_ENDPOINT']}vision/v3.2/read/analyze"
+    headers = {"Ocp-Apim-Subscription-Key": cfg["AZURE_OCR_KEY"], "Content-Type": "application/octet-stream"}
 
     try:
-        submit = requests.post(analyze_url, headers=headers, data=file_bytes, timeout=60)
-        submit.raise_for_status()
-        op_location = submit.headers.get("Operation-Location") or submit.json().get("operationLocation")
+        submit = _submit_receipt(analyze_url, headers, file_bytes)
+        op_location = submit.headers.get("Operation-Location") or _json_loads(submit.content).get("operationLocation")
         if not op_location:
-            return "⚠️ OCR did not return a valid Operation-Location."
-
-        for _ in range(60):
-            poll = requests.get(op_location, headers={"Ocp-Apim-Subscription-Key": AZURE_OCR_KEY}, timeout=30)
-            poll.raise_for_status()
-            result = poll.json()
+            raise ServiceError("OCR did not return a valid Operation-Location.")
+
+        timeout = cfg["AZURE_OCR_TIMEOUT"]
+        deadline = time.monotonic() + timeout
+        # The submit response's Retry-After says when a result is first worth asking for
+        time.sleep(min(_retry_after(submit, OCR_POLL_MIN_DELAY), timeout))
+        delay = OCR_POLL_MIN_DELAY
+        # Every wait, including one that reaches the deadline, is followed by a poll
+        while True:
+            poll = _azure_get(
+                op_location,
+                headers={"Ocp-Apim-Subscription-Key": cfg["AZURE_OCR_KEY"]},
+                timeout=30,
+                retry_deadline=deadline,
+            )
+            result = _json_loads(poll.content)
             status = result.get("status", "").lower()
 
             if status == "succeeded":
-                lines = []
                 analyze = result.get("analyzeResult", {})
-                for page in analyze.get("readResults", []):
-                    for line in page.get("lines", []):
-                        txt = line.get("text", "").strip()
-                        if txt:
-                            lines.append(txt)
-                return "\n".join(lines) if lines else "⚠️ No text found on this receipt."
+                text = "\n".join(
+                    txt
+                    for page in analyze.get("readResults", [])
+                    for line in page.get("lines", [])
+                    if (txt := line.get("text", "").strip())
+                )
+                return text
             if status == "failed":
-                return "⚠️ OCR failed to process the receipt."
-            time.sleep(1)
-
-        return "⚠️ OCR timed out while reading the receipt."
+                raise ServiceError("OCR failed to process the receipt.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ServiceError("OCR timed out while reading the receipt.")
+            # Short receipts finish in well under a second; back off for long ones
+            time.sleep(min(_retry_after(poll, delay), remaining))
+            delay = min(delay * 2, OCR_POLL_MAX_DELAY)
+    except ServiceError:
+        raise
     except Exception as e:
-        return f"⚠️ OCR error: {e}"
+        raise ServiceError(f"OCR error: {e}") from e
+
+def iter_receipt_texts(files: list[bytes]):
+    """
+    OCR several receipts concurrently, yielding `(index, text, error)` as each
+    one finishes so the caller can analyze it while the rest are still being read.
+    """
+    if not files:
+        return
+    workers = min(OCR_MAX_CONCURRENCY, len(files))
+    # Workers share this run's script context so the st.cache_data lookups work
+    pool = ThreadPoolExecutor(max_workers=workers, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    try:
+        futures = {pool.submit(extract_text_from_receipt, b): i for i, b in enumerate(files)}
+        for future in as_completed(futures):
+            try:
+                text, error = future.result(), None
+            except ServiceError as e:
+                text, error = None, e
+            yield futures[future], text, error
+    finally:
+        # A rerun closes this generator mid-loop: drop queued receipts rather than wait for them
+        pool.shutdown(wait=False, cancel_futures=True)
 
 # -----------------------------
-# Preprocess OCR via OpenAI to clean & structure
+# Extract + classify a raw receipt in one OpenAI call
 # -----------------------------
-def preprocess_ocr_text(raw_text: str) -> str:
-    """
-    Send raw OCR text to OpenAI to extract items with quantity and price in table format.
+def classify_receipt_direct(raw_text: str):
     """
-    url = f"{AZURE_OPENAI_ENDPOINT}/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions?api-version={AZURE_OPENAI_API_VERSION}"
-    headers = {"Content-Type": "application/json", "api-key": AZURE_OPENAI_KEY}
-
-    prompt = f"""
-    You are a grocery assistant. The user provides a raw receipt text:
-    {raw_text}
-
-    Extract only the purchased items with their quantity (default 1 if not present) and total price.
-    Ignore any other irrelevant text (store info, barcodes, date, etc.).
-    Return the result as a formatted text list like this (human readable):
-    Item - Quantity - Price
-    Milk - 1 - 3
-    Chips - 2 - 5
+    Extract the purchased items from raw OCR text and classify them in a single
+    round trip (same JSON shape as `classify_items_with_ai`).
     """
-    body = {
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant that formats receipt text."},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.2
-    }
+    text = _compact_receipt_text(raw_text)
+    prompt = _clamp_prompt_text(text)
+    return _flag_truncated(_chat_json(_RECEIPT_SYS, prompt), text, prompt)
 
-    try:
-        resp = requests.post(url, headers=headers, json=body, timeout=60)
-        resp.raise_for_status()
-        payload = resp.json()
-        return payload["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"⚠️ Error preprocessing OCR text: {e}"
+# -----------------------------
+# Render the summary, savings, suggestions and item tables
+# -----------------------------
+def render_analysis(data: dict) -> None:
+    essentials = data.get("essentials", [])
+    non_essentials = data.get("non_essentials", [])
+    suggestions = data.get("suggestions", [])
+
+    (essentials_total, non_essentials_total, total_spent,
+     saving_remove, saving_half) = _totals(essentials, non_essentials)
+
+    if data.get("truncated"):
+        st.warning(
+            f"⚠️ The text is longer than {MAX_PROMPT_CHARS} characters, so only its "
+            "first lines were analyzed. Totals below may be incomplete."
+        )
+
+    st.subheader("📊 Summary")
+    st.write(f"**Total Spent:** Rs.{total_spent:.2f}")
+    st.write(f"**Essentials:** Rs.{essentials_total:.2f}")
+    st.write(f"**Non-Essentials:** Rs.{non_essentials_total:.2f}")
+
+    if total_spent > 0:
+        st.subheader("💰 Potential Savings")
+        st.write(f"Remove all non-essentials: Save **Rs.{saving_remove:.2f}** ({(saving_remove/total_spent)*100:.1f}%)")
+        st.write(f"Reduce non-essentials by 50%: Save **Rs.{saving_half:.2f}** ({(saving_half/total_spent)*100:.1f}%)")
+
+    if suggestions:
+        st.subheader("📝 Suggestions")
+        for s in suggestions:
+            st.write(f"- {s}")
+
+    st.subheader("✅ Essentials")
+    st.table(essentials)
+
+    st.subheader("🚫 Non-Essentials")
+    st.table(non_essentials)
+
+def render_error(error: ServiceError) -> None:
+    st.error(f"⚠️ {error}")
+    if error.detail is not None:
+        st.write(error.detail)
+
+def render_receipt(name: str, file_hash: str, ocr_text: str) -> None:
+    """Show one receipt's OCR text and its analysis (memoized in session state)."""
+    st.header(f"🧾 {name}")
+    st.subheader("📝 Extracted Text")
+    st.text(ocr_text if ocr_text else "(No text extracted)")
+
+    if not ocr_text:
+        return
+
+    analyses = st.session_state.setdefault("receipt_analyses", {})
+    if file_hash not in analyses:
+        # One call extracts and classifies; replies are cached on disk by OCR text
+        try:
+            with st.spinner("Analyzing extracted items..."):
+                analyses[file_hash] = classify_receipt_direct(ocr_text)
+        except ServiceError as e:
+            render_error(e)
+            return
+
+    render_analysis(analyses[file_hash])
 
 # -----------------------------
 # Streamlit UI
@@ -163,7 +645,7 @@ tab_text, tab_ocr = st.tabs(["✍️ Manual Entry (Phase 1)", "🧾 Receipt OCR
 
 # ----- Phase 1: manual entry -----
 with tab_text:
-    st.write("Enter your grocery list (one per line as `Item - price`).")
+    st.write("Enter your grocery list (one per line as `Item - price`). Separate several lists with a `---` line.")
     sample_text = """Milk - 3
 Bread - 2
 Coca Cola - 5
@@ -171,98 +653,68 @@ Chips - 4
 Rice - 10"""
     grocery_input = st.text_area("Grocery List:", sample_text, height=200)
 
+    grocery_lists = [t.strip() for t in _LIST_SEPARATOR_RE.split(grocery_input) if t.strip()]
+
     if st.button("Analyze (Text)"):
-        if not grocery_input.strip():
+        if not grocery_lists:
             st.warning("Please enter your grocery list.")
-        else:
-            with st.spinner("Analyzing your grocery list..."):
-                data = classify_items_with_ai(grocery_input)
-
-            if data:
-                essentials = data.get("essentials", [])
-                non_essentials = data.get("non_essentials", [])
-                suggestions = data.get("suggestions", [])
-
-                essentials_total = _safe_sum(essentials)
-                non_essentials_total = _safe_sum(non_essentials)
-                total_spent = essentials_total + non_essentials_total
-
-                saving_remove = non_essentials_total
-                saving_half = non_essentials_total / 2.0
-
-                st.subheader("📊 Summary")
-                st.write(f"**Total Spent:** Rs.{total_spent:.2f}")
-                st.write(f"**Essentials:** Rs.{essentials_total:.2f}")
-                st.write(f"**Non-Essentials:** Rs.{non_essentials_total:.2f}")
-
-                if total_spent > 0:
-                    st.subheader("💰 Potential Savings")
-                    st.write(f"Remove all non-essentials: Save **Rs.{saving_remove:.2f}** ({(saving_remove/total_spent)*100:.1f}%)")
-                    st.write(f"Reduce non-essentials by 50%: Save **Rs.{saving_half:.2f}** ({(saving_half/total_spent)*100:.1f}%)")
-
-                if suggestions:
-                    st.subheader("📝 Suggestions")
-                    for s in suggestions:
-                        st.write(f"- {s}")
-
-                st.subheader("✅ Essentials")
-                st.table(essentials)
-
-                st.subheader("🚫 Non-Essentials")
-                st.table(non_essentials)
+        elif st.session_state.get("text_input") != grocery_input:
+            try:
+                with st.spinner("Analyzing your grocery list..."):
+                    if len(grocery_lists) == 1:
+                        analyses = [classify_items_with_ai(grocery_lists[0])]
+                    else:
+                        analyses = classify_items_batch(grocery_lists)
+            except ServiceError as e:
+                render_error(e)
+            else:
+                st.session_state.text_input = grocery_input
+                st.session_state.text_analyses = analyses
+
+    # Keep showing the last analysis across reruns until the list is edited
+    if grocery_lists and st.session_state.get("text_input") == grocery_input:
+        analyses = st.session_state.text_analyses
+        for n, data in enumerate(analyses, 1):
+            if len(analyses) > 1:
+                st.header(f"🛒 List {n}")
+            render_analysis(data)
 
 # ----- Phase 2: receipt OCR -----
 with tab_ocr:
-    st.write("Upload a receipt image or PDF; we’ll read it and analyze the items.")
-    file = st.file_uploader("Upload (JPG/PNG/PDF)", type=["jpg", "jpeg", "png", "pdf"])
-
-    if file is not None:
-        file_bytes = file.read()
-        with st.spinner("Running OCR..."):
-            ocr_text = extract_text_from_receipt(file_bytes)
-
-        st.subheader("📝 Extracted Text")
-        st.text(ocr_text if ocr_text else "(No text extracted)")
-
-        if ocr_text and not ocr_text.startswith("⚠️"):
-            with st.spinner("Cleaning OCR text..."):
-                cleaned_text = preprocess_ocr_text(ocr_text)
-            st.subheader("📝 Preprocessed Text")
-            st.text(cleaned_text)
-
-            if st.button("Analyze (Receipt Text)"):
-                with st.spinner("Analyzing extracted items..."):
-                    data = classify_items_with_ai(cleaned_text)
-
-                if data:
-                    essentials = data.get("essentials", [])
-                    non_essentials = data.get("non_essentials", [])
-                    suggestions = data.get("suggestions", [])
-
-                    essentials_total = _safe_sum(essentials)
-                    non_essentials_total = _safe_sum(non_essentials)
-                    total_spent = essentials_total + non_essentials_total
-
-                    saving_remove = non_essentials_total
-                    saving_half = non_essentials_total / 2.0
-
-                    st.subheader("📊 Summary")
-                    st.write(f"**Total Spent:** Rs.{total_spent:.2f}")
-                    st.write(f"**Essentials:** Rs.{essentials_total:.2f}")
-                    st.write(f"**Non-Essentials:** Rs.{non_essentials_total:.2f}")
-
-                    if total_spent > 0:
-                        st.subheader("💰 Potential Savings")
-                        st.write(f"Remove all non-essentials: Save **Rs.{saving_remove:.2f}** ({(saving_remove/total_spent)*100:.1f}%)")
-                        st.write(f"Reduce non-essentials by 50%: Save **Rs.D:{saving_half:.2f}** ({(saving_half/total_spent)*100:.1f}%)")
-
-                    if suggestions:
-                        st.subheader("📝 Suggestions")
-                        for s in suggestions:
-                            st.write(f"- {s}")
-
-                    st.subheader("✅ Essentials")
-                    st.table(essentials)
-
-                    st.subheader("🚫 Non-Essentials")
-                    st.table(non_essentials)
\ No newline at end of file
+    st.write("Upload one or more receipt images or PDFs; we’ll read them and analyze the items.")
+    files = st.file_uploader("Upload (JPG/PNG/PDF)", type=["jpg", "jpeg", "png", "pdf"], accept_multiple_files=True)
+
+    # Per-session results keyed on file content, so reruns never re-submit a receipt
+    ocr_results = st.session_state.setdefault("ocr_results", {})
+    receipt_analyses = st.session_state.setdefault("receipt_analyses", {})
+
+    # Drop results for receipts that are no longer uploaded (including when all are removed)
+    hashes = [hashlib.blake2b(f.getvalue(), digest_size=16).hexdigest() for f in files or []]
+    for stale in set(ocr_results) - set(hashes):
+        del ocr_results[stale]
+    for stale in set(receipt_analyses) - set(hashes):
+        del receipt_analyses[stale]
+
+    if files:
+        # One slot per upload keeps the page in upload order whatever finishes first
+        slots = [st.container() for _ in files]
+        for slot, file, h in zip(slots, files, hashes):
+            if h in ocr_results:
+                with slot:
+                    render_receipt(file.name, h, ocr_results[h])
+
+        pending = [(slot, file, h) for slot, file, h in zip(slots, files, hashes) if h not in ocr_results]
+        if pending:
+            with st.spinner(f"Reading {len(pending)} receipt(s)..."):
+                # Each receipt is analyzed as soon as its OCR is done, while the
+                # remaining ones are still being read in the background
+                for i, ocr_text, error in iter_receipt_texts([f.getvalue() for _, f, _ in pending]):
+                    slot, file, h = pending[i]
+                    with slot:
+                        if error is not None:
+                            # Failures are neither cached nor stored, so they are retried next run
+                            st.header(f"🧾 {file.name}")
+                            render_error(error)
+                            continue
+                        ocr_results[h] = ocr_text
+                        render_receipt(file.name, h, ocr_text)
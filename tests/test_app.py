@@ -0,0 +1,319 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("streamlit")
+import requests  # noqa: E402  (a streamlit dependency)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import app  # noqa: E402  (runs the Streamlit script in bare mode)
+
+
+def test_classify_locally_handles_canonical_list():
+    data = app._classify_locally("Milk - 3\nBread - 2\nChips - 4")
+    assert [it["item"] for it in data["essentials"]] == ["Milk", "Bread"]
+    assert [it["item"] for it in data["non_essentials"]] == ["Chips"]
+    assert app._totals(data["essentials"], data["non_essentials"])[2] == 9.0
+
+
+def test_classify_locally_defers_when_a_line_does_not_parse():
+    # "Beer - 5 x 2" isn't `Item - price`; dropping it would under-report totals
+    text = "Milk - 3\nBread - 2\nChips - 4\nRice - 10\nBeer - 5 x 2"
+    assert app._classify_locally(text) is None
+
+
+def test_classify_locally_defers_on_unknown_item():
+    assert app._classify_locally("Milk - 3\nWidget - 2") is None
+
+
+def test_prices_accept_loose_numeric_strings():
+    items = [
+        {"price": "-1.50"}, {"price": " .5"}, {"price": "3."}, {"price": 2},
+        {"price": "n/a"}, {"price": "nan"}, {"price": "inf"}, {"price": float("-inf")}, {"price": 10**400}, {},
+    ]
+    assert app._prices(items) == [-1.5, 0.5, 3.0, 2.0]
+
+
+def test_compact_receipt_text_keeps_item_lines():
+    raw = "Card - 2\nChange purse 5\n  Milk    1   3.00 \nSubtotal 3.00\nTOTAL 10.00\n4006381333931\nThank you!"
+    assert app._compact_receipt_text(raw) == "Card - 2\nChange purse 5\nMilk 1 3.00"
+
+
+def test_clamp_prompt_text_cuts_at_a_line_boundary():
+    text = "Milk - 3\n" * (app.MAX_PROMPT_CHARS // 4)
+    clamped = app._clamp_prompt_text(text)
+    assert len(clamped) <= app.MAX_PROMPT_CHARS
+    assert clamped.endswith("Milk - 3")
+
+
+ANALYSIS = {"essentials": [], "non_essentials": [], "suggestions": []}
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    cfg = {
+        "AZURE_OPENAI_KEY": "key",
+        "AZURE_OPENAI_ENDPOINT": "https://openai.test",
+        "AZURE_OPENAI_DEPLOYMENT": "test",
+        "AZURE_OPENAI_API_VERSION": "2024-02-01",
+        "LLM_CACHE_PATH": str(tmp_path / "llm_cache"),
+        "AZURE_OCR_KEY": "key",
+        "AZURE_OCR_ENDPOINT": "https://ocr.test/",
+        "AZURE_OCR_TIMEOUT": 1.0,
+    }
+    monkeypatch.setattr(app, "get_settings", lambda: cfg)
+    return cfg
+
+
+def fake_chat(monkeypatch, reply):
+    """Replace the streaming call; `reply(user_text)` gives the raw reply text."""
+    prompts = []
+
+    def stream(body, on_retry=None):
+        prompts.append(body["messages"][1]["content"])
+        return reply(prompts[-1])
+
+    monkeypatch.setattr(app, "_stream_chat_completion", stream)
+    return prompts
+
+
+def test_batch_reply_of_the_wrong_length_is_not_cached(settings, monkeypatch):
+    replies = iter([[ANALYSIS], [ANALYSIS, ANALYSIS]])
+    prompts = fake_chat(monkeypatch, lambda _: json.dumps(next(replies)))
+    texts = ["Widget - 2", "Gadget - 3"]
+    with pytest.raises(app.ServiceError):
+        app.classify_items_batch(texts)
+    key = app._llm_cache_key(app._CLASSIFY_BATCH_SYS, prompts[0])
+    assert app._llm_cache_get(key) is None
+    assert app.classify_items_batch(texts) == [ANALYSIS, ANALYSIS]
+    assert len(prompts) == 2
+
+
+def test_batch_requests_stay_within_the_prompt_budget(settings, monkeypatch):
+    def reply(text):
+        lists = text.split(app._BATCH_SEPARATOR)
+        return json.dumps([ANALYSIS] * len(lists) if len(lists) > 1 else ANALYSIS)
+
+    prompts = fake_chat(monkeypatch, reply)
+    texts = [f"Widget {n} - 2\n" * 300 for n in range(5)]
+    assert app.classify_items_batch(texts) == [ANALYSIS] * 5
+    assert len(prompts) == 3
+    assert all(len(p) <= app.MAX_PROMPT_CHARS for p in prompts)
+
+
+def test_truncated_analysis_is_flagged_for_every_render(settings, monkeypatch):
+    prompts = fake_chat(monkeypatch, lambda _: json.dumps(ANALYSIS))
+    data = app.classify_items_with_ai("Widget - 2\n" * app.MAX_PROMPT_CHARS)
+    assert len(prompts[0]) <= app.MAX_PROMPT_CHARS
+    assert data["truncated"] is True
+    assert "truncated" not in app.classify_items_with_ai("Widget - 2")
+
+
+class FakeResponse:
+    def __init__(self, status=200, headers=None, body=b"{}", lines=()):
+        self.status_code = status
+        self.ok = status < 400
+        self.headers = headers or {}
+        self.content = body
+        self.text = body.decode()
+        self.encoding = None
+        self._lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self._lines)
+
+
+class FakeSession:
+    """Answers every GET/POST with the next queued response."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def _next(self, *args, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+    get = post = _next
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(app.time, "sleep", waited.append)
+    monkeypatch.setattr(app.random, "uniform", lambda a, b: 0.0)
+    return waited
+
+
+def fake_session(monkeypatch, *responses):
+    session = FakeSession(*responses)
+    monkeypatch.setattr(app, "get_session", lambda: session)
+    return session
+
+
+@pytest.mark.parametrize("status", sorted(app.RETRY_STATUSES))
+def test_retry_transient_retries_rate_limits_and_server_errors(monkeypatch, sleeps, status):
+    session = fake_session(monkeypatch, FakeResponse(status), FakeResponse(200))
+    assert app._azure_get("https://azure.test").status_code == 200
+    assert session.calls == 2
+    assert sleeps == [app.RETRY_INITIAL_DELAY]
+
+
+def test_retry_transient_does_not_retry_client_errors(monkeypatch, sleeps):
+    session = fake_session(monkeypatch, FakeResponse(400), FakeResponse(200))
+    with pytest.raises(requests.HTTPError):
+        app._azure_get("https://azure.test")
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_retry_transient_waits_at_least_retry_after(monkeypatch, sleeps):
+    fake_session(monkeypatch, FakeResponse(429, {"Retry-After": "20"}), FakeResponse(200))
+    retries = []
+    app._azure_get("https://azure.test", on_retry=lambda delay, attempt: retries.append((delay, attempt)))
+    assert sleeps == [20.0]
+    assert retries == [(20.0, 1)]
+
+
+def test_retry_transient_gives_up_on_retry_after_over_the_cap(monkeypatch, sleeps):
+    retry_after = str(app.RETRY_MAX_DELAY + 1)
+    session = fake_session(monkeypatch, FakeResponse(429, {"Retry-After": retry_after}), FakeResponse(200))
+    with pytest.raises(requests.HTTPError):
+        app._azure_get("https://azure.test")
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_retry_transient_stops_after_the_last_attempt(monkeypatch, sleeps):
+    session = fake_session(monkeypatch, *[FakeResponse(503)] * (app.RETRY_ATTEMPTS + 1))
+    with pytest.raises(requests.HTTPError):
+        app._azure_get("https://azure.test")
+    assert session.calls == app.RETRY_ATTEMPTS
+    assert sleeps == [app.RETRY_INITIAL_DELAY * 2 ** n for n in range(app.RETRY_ATTEMPTS - 1)]
+
+
+def test_retry_transient_never_sleeps_past_the_deadline(monkeypatch, sleeps):
+    session = fake_session(monkeypatch, FakeResponse(503), FakeResponse(200))
+    with pytest.raises(requests.HTTPError):
+        app._azure_get("https://azure.test", retry_deadline=app.time.monotonic() + 0.5)
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_chat_json_caches_only_valid_replies(settings, monkeypatch):
+    replies = iter([{"essentials": "Milk"}, ANALYSIS])
+    prompts = fake_chat(monkeypatch, lambda _: json.dumps(next(replies)))
+    with pytest.raises(app.ServiceError):
+        app._chat_json(app._CLASSIFY_SYS, "Widget - 2")
+    assert app._llm_cache_get(app._llm_cache_key(app._CLASSIFY_SYS, "Widget - 2")) is None
+    assert app._chat_json(app._CLASSIFY_SYS, "Widget - 2") == ANALYSIS
+    assert app._chat_json(app._CLASSIFY_SYS, "Widget - 2") == ANALYSIS
+    assert len(prompts) == 2
+
+
+def test_chat_json_ignores_an_invalid_cached_reply(settings, monkeypatch):
+    app._llm_cache_set(app._llm_cache_key(app._CLASSIFY_SYS, "Widget - 2"), ["not", "an", "analysis"])
+    prompts = fake_chat(monkeypatch, lambda _: json.dumps(ANALYSIS))
+    assert app._chat_json(app._CLASSIFY_SYS, "Widget - 2") == ANALYSIS
+    assert len(prompts) == 1
+
+
+class FakeClock:
+    """Stands in for the `time` module; sleeping just advances the clock."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.log = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.log.append("sleep")
+        self.now += seconds
+
+
+class LoggedSession(FakeSession):
+    def __init__(self, clock, *responses):
+        super().__init__(*responses)
+        self.clock = clock
+
+    def _next(self, *args, **kwargs):
+        self.clock.log.append("request")
+        return super()._next(*args, **kwargs)
+
+    get = post = _next
+
+
+def fake_ocr(monkeypatch, *responses):
+    clock = FakeClock()
+    monkeypatch.setattr(app, "time", clock)
+    monkeypatch.setattr(app, "_ocr_next_submit", 0.0)
+    session = LoggedSession(clock, *responses)
+    monkeypatch.setattr(app, "get_session", lambda: session)
+    return clock
+
+
+def ocr_status(status, **headers):
+    return FakeResponse(200, headers, json.dumps({"status": status}).encode())
+
+
+def test_ocr_polls_after_a_retry_after_longer_than_the_timeout(settings, monkeypatch):
+    submit = FakeResponse(202, {"Operation-Location": "https://ocr.test/op", "Retry-After": "100"})
+    clock = fake_ocr(monkeypatch, submit, ocr_status("succeeded"))
+    assert app.extract_text_from_receipt.__wrapped__(b"receipt") == ""
+    assert clock.log == ["request", "sleep", "request"]
+
+
+def test_ocr_polls_once_more_after_the_last_wait(settings, monkeypatch):
+    submit = FakeResponse(202, {"Operation-Location": "https://ocr.test/op"})
+    clock = fake_ocr(monkeypatch, submit, *[ocr_status("running", **{"Retry-After": "0.4"})] * 5)
+    with pytest.raises(app.ServiceError, match="timed out"):
+        app.extract_text_from_receipt.__wrapped__(b"receipt")
+    assert clock.log[-2:] == ["sleep", "request"]
+    assert clock.now == settings["AZURE_OCR_TIMEOUT"]
+
+
+def sse(*events):
+    return [f"data: {json.dumps(e) if isinstance(e, dict) else e}" for e in events]
+
+
+def delta(text):
+    return {"choices": [{"delta": {"content": text}}]}
+
+
+def test_stream_joins_deltas_until_done(settings, monkeypatch):
+    lines = ["", ": keep-alive"] + sse({"choices": []}, delta('{"a"'), delta(": 1}"), "[DONE]", delta("ignored"))
+    fake_session(monkeypatch, FakeResponse(lines=lines))
+    assert app._stream_chat_completion({"messages": []}) == '{"a": 1}'
+
+
+def test_stream_reports_an_error_event(settings, monkeypatch):
+    error = {"code": "content_filter", "message": "filtered"}
+    fake_session(monkeypatch, FakeResponse(lines=sse(delta("{"), {"error": error})))
+    with pytest.raises(app.ServiceError) as info:
+        app._chat_json(app._CLASSIFY_SYS, "Widget - 2")
+    assert info.value.detail == error
+
+
+def test_stream_reports_a_malformed_chunk(settings, monkeypatch):
+    fake_session(monkeypatch, FakeResponse(lines=sse(delta("{"), "{not json")))
+    with pytest.raises(app.ServiceError) as info:
+        app._chat_json(app._CLASSIFY_SYS, "Widget - 2")
+    assert info.value.detail == "{not json"